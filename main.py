@@ -1,11 +1,27 @@
+import os
 import re
+import csv
+import hmac
 import json
-from datetime import datetime
+import logging
+import hashlib
+import secrets
+import stat
+import tempfile
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Optional
 
 import pandas as pd
 import streamlit as st
 
+try:
+    import orjson  # opcional: serializa más rápido y escribe UTF-8 directo
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 # =========================
 # CONFIG
 # =========================
@@ -20,6 +36,14 @@ SUB_DIR = DATA_DIR / "submissions"
 RAW_DIR.mkdir(parents=True, exist_ok=True)
 SUB_DIR.mkdir(parents=True, exist_ok=True)
 
+# Passwords: scrypt con salt por compañía ("scrypt$n$r$p$salt$hash").
+# Lo que no tenga ese prefijo es texto plano viejo y se migra en el próximo login.
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2**14, 8, 1
+_SCRYPT_PREFIX = "scrypt$"
+
+_SAFE_NAME_RE = re.compile(r"[^a-zA-Z0-9_-]+")
+_SAFE_FILENAME_RE = re.compile(r"[^a-zA-Z0-9._-]+")
+
 # Core metrics (hardcode por ahora, luego lo leemos del Excel)
 CORE_METRICS = [
     {"name": "Revenue", "what": "Ingresos del período"},
@@ -33,39 +57,122 @@ CORE_METRICS = [
 # HELPERS
 # =========================
 def safe_name(text: str) -> str:
-    return re.sub(r"[^a-zA-Z0-9_-]+", "_", (text or "").strip())
+    return _SAFE_NAME_RE.sub("_", (text or "").strip())
+
+@st.cache_resource(show_spinner=False)
+def _logo_bytes():
+    # se lee una sola vez por proceso, no en cada rerun
+    return LOGO_PATH.read_bytes() if LOGO_PATH.exists() else None
 
 def render_header():
     col1, col2 = st.columns([6, 1])
     with col1:
         st.title(APP_TITLE)
     with col2:
-        if LOGO_PATH.exists():
-            st.image(str(LOGO_PATH), width=120)
-
-def load_companies() -> pd.DataFrame:
-    if not COMPANIES_FILE.exists():
-        # crea un archivo base si no existe
-        df = pd.DataFrame([{"company": "Admin", "password": "adminpass"}])
-        df.to_csv(COMPANIES_FILE, index=False)
-    return pd.read_csv(COMPANIES_FILE).fillna("")
-
-def check_login(company: str, password: str) -> bool:
-    df = load_companies()
-    row = df[df["company"] == company].head(1)
-    if row.empty:
+        logo = _logo_bytes()
+        if logo:
+            st.image(logo, width=120)
+
+@st.cache_data(show_spinner=False)
+def _companies_index(mtime: float) -> dict:
+    # mtime es parte de la key del cache: si el CSV cambia, se vuelve a leer
+    # company -> fila, para login en O(1) (si hay duplicados gana la primera)
+    companies = {}
+    with open(COMPANIES_FILE, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            row = {k: v or "" for k, v in row.items() if k is not None}
+            companies.setdefault(row["company"], row)
+    return companies
+
+def hash_password(plain: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(plain.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"{_SCRYPT_PREFIX}{SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def verify_password(plain: str, stored: str) -> bool:
+    if not stored.startswith(_SCRYPT_PREFIX):
+        return hmac.compare_digest(plain.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        expected = bytes.fromhex(digest)
+        actual = hashlib.scrypt(
+            plain.encode("utf-8"), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p), dklen=len(expected)
+        )
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+def needs_rehash(stored: str) -> bool:
+    return not stored.startswith(_SCRYPT_PREFIX)
+
+def companies_mtime() -> float:
+    # un solo stat en el caso normal; el archivo base sólo se crea si falta
+    try:
+        return COMPANIES_FILE.stat().st_mtime
+    except FileNotFoundError:
+        pass
+    # crea un archivo base si no existe
+    with open(COMPANIES_FILE, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["company", "password"])
+        writer.writerow(["Admin", hash_password("adminpass")])
+    return COMPANIES_FILE.stat().st_mtime
+
+def load_companies() -> dict:
+    return _companies_index(companies_mtime())
+
+def set_password(company: str, plain: str):
+    # reescribe todas las filas de esa compañía con el hash nuevo
+    with open(COMPANIES_FILE, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    hashed = hash_password(plain)
+    for row in rows:
+        if row["company"] == company:
+            row["password"] = hashed
+    # escribimos a un temporal propio (nombre único por escritor) y lo renombramos:
+    # nunca queda un CSV a medio escribir
+    tmp = tempfile.NamedTemporaryFile(
+        "w", dir=COMPANIES_FILE.parent, prefix=".companies_", suffix=".csv.tmp",
+        newline="", encoding="utf-8", delete=False,
+    )
+    try:
+        with tmp as f:
+            # filas con celdas de más: se descarta lo que no tiene columna
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore", lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rows)
+        # el temporal se crea con 0600: conservamos los permisos del archivo original
+        os.chmod(tmp.name, stat.S_IMODE(COMPANIES_FILE.stat().st_mode))
+        os.replace(tmp.name, COMPANIES_FILE)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+    _companies_index.clear()
+
+def check_login(companies: dict, company: str, password: str) -> bool:
+    # sin password no hay nada que comparar (y un password vacío en el CSV no debe abrir sesión)
+    if not password:
+        return False
+    row = companies.get(company)
+    if row is None:
         return False
-    return row.iloc[0]["password"] == password
+    return verify_password(password, row["password"])
+
+def utc_ts() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
 
 def period_folder(company: str, year: int, quarter: str, month_in_q: int) -> Path:
     return Path(safe_name(company)) / str(year) / quarter / f"month_{month_in_q}"
 
-def save_raw_upload(company: str, year: int, quarter: str, month_in_q: int, file) -> Path:
+def save_raw_upload(company: str, year: int, quarter: str, month_in_q: int, file, ts: Optional[str] = None, index: int = 0) -> Path:
     dest_dir = RAW_DIR / period_folder(company, year, quarter, month_in_q)
     dest_dir.mkdir(parents=True, exist_ok=True)
-    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    filename = re.sub(r"[^a-zA-Z0-9._-]+", "_", file.name)
-    dest_path = dest_dir / f"{ts}__{filename}"
+    ts = ts or utc_ts()
+    filename = _SAFE_FILENAME_RE.sub("_", file.name)
+    # el índice evita choques entre archivos de un mismo lote (mismo ts)
+    dest_path = dest_dir / f"{ts}_{index:02d}__{filename}"
     with open(dest_path, "wb") as f:
         f.write(file.getbuffer())
     return dest_path
@@ -73,7 +180,7 @@ def save_raw_upload(company: str, year: int, quarter: str, month_in_q: int, file
 def save_core_metrics(company: str, year: int, quarter: str, month_in_q: int, metrics: dict) -> Path:
     dest_dir = SUB_DIR / period_folder(company, year, quarter, month_in_q)
     dest_dir.mkdir(parents=True, exist_ok=True)
-    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    ts = utc_ts()
 
     payload = {
         "meta": {
@@ -88,30 +195,92 @@ def save_core_metrics(company: str, year: int, quarter: str, month_in_q: int, me
     }
 
     json_path = dest_dir / f"core_{ts}.json"
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        json_path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    else:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
 
     # también guardamos CSV
     csv_path = dest_dir / f"core_{ts}.csv"
-    pd.DataFrame([{"metric": k, "value": v} for k, v in metrics.items()]).to_csv(csv_path, index=False)
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["metric", "value"])
+        writer.writerows(metrics.items())
 
     return json_path
 
 # =========================
 # UI
 # =========================
+# Cada tab es un fragment: interactuar adentro sólo re-ejecuta ese bloque,
+# no el script entero (header, login, sidebar).
+@st.fragment
+def raw_upload_section(company: str, year: int, quarter: str, month_in_q: int):
+    st.subheader("Subir reportes en formato convencional")
+    uploads = st.file_uploader("Subir archivos (xlsx/csv/pdf/etc.)", type=None, accept_multiple_files=True)
+    if uploads and st.button("Guardar archivos"):
+        # un solo timestamp por lote
+        ts = utc_ts()
+        for i, up in enumerate(uploads):
+            path = save_raw_upload(company, year, quarter, month_in_q, up, ts=ts, index=i)
+            st.success(f"Guardado: {path}")
+
+@st.fragment
+def core_metrics_section(company: str, year: int, quarter: str, month_in_q: int):
+    st.subheader("Carga manual de métricas Core")
+    st.caption("Estas métricas son las core acordadas para el MVP.")
+
+    # una sola tabla editable en vez de number_input + checkbox por métrica
+    editor_df = pd.DataFrame(
+        [{"metric": m["name"], "what": m["what"], "value": 0.0, "include": True} for m in CORE_METRICS]
+    )
+
+    with st.form("core_form"):
+        edited = st.data_editor(
+            editor_df,
+            column_config={
+                "metric": st.column_config.TextColumn("Métrica", disabled=True),
+                "what": st.column_config.TextColumn("Descripción", disabled=True),
+                "value": st.column_config.NumberColumn("Valor", step=0.01),
+                "include": st.column_config.CheckboxColumn("Incluir"),
+            },
+            hide_index=True,
+            use_container_width=True,
+            key="core_editor",
+        )
+
+        submitted = st.form_submit_button("Enviar métricas Core")
+
+    if submitted:
+        # una celda vaciada cuenta como no incluida
+        provided = edited["include"] & edited["value"].notna()
+        values = dict(zip(edited.loc[provided, "metric"], edited.loc[provided, "value"].astype(float).tolist()))
+
+        # Si querés core obligatorias, invertimos esto:
+        # missing = edited.loc[~provided, "metric"].tolist()
+        # if missing: error
+        # Por ahora permitimos enviar lo que haya.
+        path = save_core_metrics(company, year, quarter, month_in_q, values)
+        st.success(f"Métricas guardadas: {path}")
+
 def login_screen():
     render_header()
     st.subheader("Login por compañía")
 
-    df = load_companies()
-    companies = df["company"].tolist()
+    companies = load_companies()
 
-    company = st.selectbox("Compañía", companies)
+    company = st.selectbox("Compañía", list(companies))
     password = st.text_input("Password", type="password")
 
     if st.button("Ingresar"):
-        if check_login(company, password):
+        if check_login(companies, company, password):
+            if needs_rehash(companies[company]["password"]):
+                # la migración es oportunista: si no se puede escribir, el login sigue igual
+                try:
+                    set_password(company, password)
+                except (OSError, ValueError):
+                    logger.exception("No se pudo migrar el password de %s", company)
             st.session_state["company"] = company
             st.rerun()
         else:
@@ -136,37 +305,11 @@ def portal_screen():
 
     # Upload raw
     with tabs[0]:
-        st.subheader("Subir reportes en formato convencional")
-        up = st.file_uploader("Subir archivo (xlsx/csv/pdf/etc.)", type=None)
-        if up is not None and st.button("Guardar archivo"):
-            path = save_raw_upload(company, int(year), quarter, int(month_in_q), up)
-            st.success(f"Guardado: {path}")
+        raw_upload_section(company, int(year), quarter, int(month_in_q))
 
     # Core manual
     with tabs[1]:
-        st.subheader("Carga manual de métricas Core")
-        st.caption("Estas métricas son las core acordadas para el MVP.")
-
-        values = {}
-        missing = []
-
-        with st.form("core_form"):
-            for m in CORE_METRICS:
-                v = st.number_input(m["name"], value=0.0, step=0.01, help=m["what"])
-                provided = st.checkbox(f"Incluir {m['name']}", value=True)
-                if provided:
-                    values[m["name"]] = float(v)
-                else:
-                    missing.append(m["name"])
-
-            submitted = st.form_submit_button("Enviar métricas Core")
-
-        if submitted:
-            # Si querés core obligatorias, invertimos esto:
-            # if missing: error
-            # Por ahora permitimos enviar lo que haya.
-            path = save_core_metrics(company, int(year), quarter, int(month_in_q), values)
-            st.success(f"Métricas guardadas: {path}")
+        core_metrics_section(company, int(year), quarter, int(month_in_q))
 
 # =========================
 # MAIN